@@ -15,37 +15,80 @@ Install: pip install flask flask-socketio eventlet werkzeug
 Run: python chat_app.py
 """
 
+import eventlet
+
+# patch before anything else imports socket/threading/time, so blocking I/O
+# yields to the hub and one process can hold thousands of idle sockets
+eventlet.monkey_patch()
+
+import atexit
 import os
+import collections
+import hashlib
+import json
+import mimetypes
+import queue
 import sqlite3
-import uuid
+import tempfile
+import threading
+import secrets
+import shutil
+import socket
 import time
-import math
+from contextlib import contextmanager
+from dataclasses import dataclass
 from datetime import datetime, timedelta
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional, List, Tuple
+from typing import Dict, Optional, List, Tuple, Union
+from urllib.parse import unquote
 
 from flask import (
     Flask,
-    render_template_string,
+    Request,
+    render_template,
+    stream_template,
+    Response,
     request,
     jsonify,
     redirect,
     url_for,
     session,
+    g,
     flash,
     abort,
     send_from_directory,
 )
+import eventlet.wsgi
+from eventlet import tpool
 from flask_socketio import SocketIO, emit, join_room as sio_join, leave_room as sio_leave
-from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash, check_password_hash
+from markupsafe import Markup, escape
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 
 # ---------------------------- CONFIG ----------------------------
 DB_FILE = os.getenv("CHAT_DB", "chat_app.sqlite3")
 UPLOAD_DIR = Path(os.getenv("CHAT_UPLOADS", "uploads"))
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 MAX_CONTENT_LENGTH = 50 * 1024 * 1024  # 50 MB
-ALLOWED_EXT = {".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp", ".webm", ".mp3", ".wav", ".ogg", ".pdf", ".txt"}
+ALLOWED_EXT = frozenset({".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp", ".webm", ".mp3", ".wav", ".ogg", ".pdf", ".txt"})
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # copy buffer for raw-body uploads and chunk parts
+MAX_FORM_MEMORY_SIZE = 64 * 1024  # non-file form fields; file parts never sit in memory (see ChatRequest)
+# public base for upload links (e.g. a CDN); when unset, links are built with url_for
+UPLOAD_URL_BASE = (os.getenv("CHAT_UPLOAD_URL_BASE") or "").rstrip("/") or None
+CHUNK_DIR = UPLOAD_DIR / ".chunks"  # parts of resumable uploads, one dir per uploadId
+CHUNK_PART_SIZE = 1024 * 1024  # client slices files into parts of this size
+CHUNK_MAX_PARTS = -(-MAX_CONTENT_LENGTH // CHUNK_PART_SIZE)
+CHUNK_TTL = 24 * 3600  # seconds before an unfinished upload is discarded
+# hand upload bodies to the front-end server via X-Sendfile (Apache/lighttpd) instead of streaming them from Python
+USE_X_SENDFILE = os.getenv("CHAT_X_SENDFILE", "0") == "1"
+# nginx equivalent: internal location that aliases UPLOAD_DIR, served via X-Accel-Redirect
+UPLOAD_ACCEL_PREFIX = (os.getenv("CHAT_X_ACCEL_PREFIX") or "").rstrip("/") or None
+# redis://host:6379/0 to share rooms and broadcasts between several server processes
+MESSAGE_QUEUE = os.getenv("CHAT_REDIS_URL") or None
+CORS_ORIGINS = os.getenv("CHAT_CORS_ORIGINS") or None  # "*" or comma-separated; default same-origin only
+if CORS_ORIGINS and CORS_ORIGINS != "*":
+    CORS_ORIGINS = [o.strip() for o in CORS_ORIGINS.split(",")]
 
 PORT = int(os.getenv("PORT", 5000))
 SECRET_KEY = os.getenv("CHAT_SECRET", "change_me_now")
@@ -61,10 +104,43 @@ else:
     ADMIN_PASS_HASHED = generate_password_hash(ADMIN_PASS_ENV)
 
 # Flask + SocketIO
+class UploadSpool:
+    """Named temp file in UPLOAD_DIR that hashes bytes as the form parser writes them.
+
+    save_upload links it into place under its hash, so the body is never copied;
+    the temp name itself is removed when the request closes its files.
+    """
+
+    def __init__(self):
+        self._file = tempfile.NamedTemporaryFile("w+b", dir=UPLOAD_DIR, prefix=".part-")
+        self.name = self._file.name
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        return self._file.write(data)
+
+    def __getattr__(self, attr):
+        return getattr(self._file, attr)
+
+
+class ChatRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # stream multipart file parts straight into UPLOAD_DIR instead of a SpooledTemporaryFile
+        return UploadSpool()
+
+
 app = Flask(__name__)
+app.request_class = ChatRequest
 app.config["SECRET_KEY"] = SECRET_KEY
 app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
-socketio = SocketIO(app, async_mode="eventlet")
+app.config["MAX_FORM_MEMORY_SIZE"] = MAX_FORM_MEMORY_SIZE
+app.config["USE_X_SENDFILE"] = USE_X_SENDFILE
+# websocket frames get permessage-deflate from eventlet when the browser offers it;
+# these settings cover the long-polling transport, compressing payloads over 512 bytes
+socketio = SocketIO(app, async_mode="eventlet", cors_allowed_origins=CORS_ORIGINS,
+                    message_queue=MESSAGE_QUEUE, channel="chat",
+                    http_compression=True, compression_threshold=512)
 
 # ---------------------------- DATABASE ---------------------------
 def init_db():
@@ -85,9 +161,13 @@ def init_db():
             ts REAL NOT NULL,
             content TEXT NOT NULL,
             token TEXT,
-            room_code TEXT
+            room_code TEXT,
+            attach TEXT
         )"""
     )
+    # databases created before attachments were structured lack the column
+    if "attach" not in {row[1] for row in cur.execute("PRAGMA table_info(messages)")}:
+        cur.execute("ALTER TABLE messages ADD COLUMN attach TEXT")
     cur.execute(
         """CREATE TABLE IF NOT EXISTS rooms(
             code TEXT PRIMARY KEY,
@@ -97,79 +177,292 @@ def init_db():
         )"""
     )
     cur.execute("""CREATE TABLE IF NOT EXISTS banned(token TEXT PRIMARY KEY)""")
+    # history, IP-link and log queries all filter messages by one column and order by ts
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_msg_room_ts ON messages(room_code, ts DESC)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_msg_token_ts ON messages(token, ts DESC)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_msg_ip_ts ON messages(sender_ip, ts DESC)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_msg_ts ON messages(ts, id)")
+    # planner statistics: ANALYZE when there are none yet, or once messages has doubled since the last run.
+    # (PRAGMA optimize can't be relied on here: before SQLite 3.46 it does nothing right after open, and an
+    # ANALYZE of an empty DB creates sqlite_stat1 without writing any rows.)
+    has_stats = cur.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'").fetchone()
+    stat = has_stats and cur.execute("SELECT stat FROM sqlite_stat1 WHERE tbl='messages' LIMIT 1").fetchone()
+    analyzed_rows = int(stat[0].split()[0]) if stat else 0
+    rows_now = cur.execute("SELECT max(id) FROM messages").fetchone()[0] or 0
+    if not analyzed_rows or rows_now >= 2 * analyzed_rows:
+        cur.execute("ANALYZE")
+    # WAL is stored in the database file, so this sticks across restarts
+    cur.execute("PRAGMA journal_mode=WAL")
     conn.commit()
+    cur.close()  # finalizes the journal_mode statement; left open, it keeps the file locked for the readers below
     conn.close()
+    load_mirrors()
+
+
+# one shared writer serialized by _write_lock, plus a small pool of read-only
+# connections. WAL means readers and the writer never block each other on SQLite
+# locks, but sqlite3 calls run on the eventlet hub: a long admin read still stalls
+# every green thread (chat writes included) in this process until it returns.
+# All connections are autocommit, so writes need no explicit commit.
+READ_POOL_SIZE = 4
+_write_lock = threading.Lock()
+_write_conn: Optional[sqlite3.Connection] = None
+_read_pool = queue.LifoQueue(maxsize=READ_POOL_SIZE)
+
+# per-connection tuning; safe with WAL (NORMAL sync only risks the last commits on power loss)
+CONN_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=5000",
+)
 
 
-def db_run(query: str, params: tuple = (), fetch: bool = False):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute(query, params)
-    data = cur.fetchall() if fetch else None
-    conn.commit()
-    conn.close()
-    return data
+def _connect(readonly: bool = False) -> sqlite3.Connection:
+    if readonly:
+        target, uri = Path(DB_FILE).resolve().as_uri() + "?mode=ro", True
+    else:
+        target, uri = DB_FILE, False
+    conn = sqlite3.connect(target, uri=uri, check_same_thread=False, isolation_level=None, cached_statements=256)
+    for pragma in CONN_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def get_write_conn() -> sqlite3.Connection:
+    """The shared writer; callers must hold _write_lock."""
+    global _write_conn
+    if _write_conn is None:
+        _write_conn = _connect()
+    return _write_conn
+
+
+@contextmanager
+def read_conn():
+    # never block on an empty pool: open an extra reader and drop it if the pool is full on return
+    try:
+        conn = _read_pool.get_nowait()
+    except queue.Empty:
+        conn = _connect(readonly=True)
+    try:
+        yield conn
+    finally:
+        try:
+            _read_pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+def close_db():
+    global _write_conn
+    with _write_lock:
+        if _write_conn is not None:
+            _write_conn.close()
+            _write_conn = None
+    while True:
+        try:
+            _read_pool.get_nowait().close()
+        except queue.Empty:
+            break
+
+
+def _iter_rows(query: str, params: tuple):
+    # the reader is checked out on first next() and returned once the rows run out (or the generator is closed)
+    with read_conn() as conn:
+        yield from conn.execute(query, params)
+
+
+def db_run(query: str, params: tuple = (), fetch: Union[bool, str] = False):
+    """fetch=True queries run on a read-only connection, so they must not write.
+    fetch="iter" yields rows straight off the cursor instead of building a list."""
+    if fetch == "iter":
+        return _iter_rows(query, params)
+    if fetch:
+        with read_conn() as conn:
+            return conn.execute(query, params).fetchall()
+    with _write_lock:
+        get_write_conn().execute(query, params)
+    return None
 
 
 # ------------------------- TOKEN HELPERS -------------------------
 def ensure_token_record(token: str, name: str):
     """Create or update token->name mapping and ensure public token exists."""
-    rows = db_run("SELECT public_token FROM tokens WHERE token=?", (token,), fetch=True)
-    if rows:
-        db_run("UPDATE tokens SET name=? WHERE token=?", (name, token))
-    else:
-        public = str(uuid.uuid4())[:8]
-        db_run(
-            "INSERT OR REPLACE INTO tokens (token,name,public_token,created_ts) VALUES (?,?,?,?)",
-            (token, name, public, time.time()),
-        )
+    # one upsert: the fresh public token and created_ts only land on insert, existing rows just get the name
+    db_run(
+        "INSERT INTO tokens (token,name,public_token,created_ts) VALUES (?,?,?,?) "
+        "ON CONFLICT(token) DO UPDATE SET name=excluded.name",
+        (token, name, secrets.token_hex(4), time.time()),
+    )
+    # all writes to tokens go through here; dropping just this token keeps every other user's entry warm
+    _token_cache.pop(token, None)
+
+
+TOKEN_CACHE_SIZE = 4096
+_token_cache: Dict[str, Tuple[Optional[str], Optional[str]]] = {}  # insertion-ordered, oldest evicted first
+
+
+def _token_info(token: str) -> Tuple[Optional[str], Optional[str]]:
+    """Cached (name, public_token) for a secret token; (None, None) if unknown."""
+    info = _token_cache.get(token)
+    if info is None:
+        rows = db_run("SELECT name, public_token FROM tokens WHERE token=?", (token,), fetch=True)
+        info = tuple(rows[0]) if rows else (None, None)
+        if len(_token_cache) >= TOKEN_CACHE_SIZE:
+            del _token_cache[next(iter(_token_cache))]
+        _token_cache[token] = info
+    return info
 
 
 def get_name_by_token(token: str) -> Optional[str]:
     if not token:
         return None
-    rows = db_run("SELECT name FROM tokens WHERE token=?", (token,), fetch=True)
-    return rows[0][0] if rows else None
+    return _token_info(token)[0]
 
 
 def get_public_by_token(token: str) -> Optional[str]:
     if not token:
         return None
-    rows = db_run("SELECT public_token FROM tokens WHERE token=?", (token,), fetch=True)
-    return rows[0][0] if rows else None
+    return _token_info(token)[1]
 
 
 # ------------------------- MESSAGE HELPERS -----------------------
-def store_message(sender_ip: str, content: str, token: str = None, room_code: str = None):
-    db_run(
-        "INSERT INTO messages (sender_ip, ts, content, token, room_code) VALUES (?,?,?,?,?)",
-        (sender_ip, time.time(), content, token, room_code),
+# messages are queued and written in batches; one transaction (one fsync) per flush
+MSG_FLUSH_INTERVAL = 0.05  # seconds
+MAX_MSG_LEN = 4000  # characters kept per chat message
+MAX_ROOM_LEN = 64  # longest room code accepted from a client
+MSG_INSERT_ROWS = 150  # rows per INSERT; 6 params each stays under SQLite's default 999-variable limit
+MSG_QUEUE_MAX = 20000  # rows held while the DB keeps failing; beyond this the oldest are dropped
+_msg_queue = collections.deque(maxlen=MSG_QUEUE_MAX)
+# errors caused by one row's values rather than the database itself
+ROW_DATA_ERRORS = (sqlite3.InterfaceError, sqlite3.ProgrammingError, sqlite3.IntegrityError)
+_msg_lock = threading.Lock()
+
+
+_flusher_started = False
+
+
+def store_message(sender_ip: str, content: str, token: str = None, room_code: str = None, attach: dict = None):
+    global _flusher_started
+    attach_json = json.dumps(attach, separators=(",", ":")) if attach else None
+    with _msg_lock:
+        _msg_queue.append((sender_ip, time.time(), content, token, room_code, attach_json))
+    # started on first use rather than from __main__, so it also runs under gunicorn & co.
+    if not _flusher_started:
+        _flusher_started = True
+        socketio.start_background_task(message_flusher)
+
+
+@lru_cache(maxsize=MSG_INSERT_ROWS)
+def _msg_insert_sql(rows: int) -> str:
+    return "INSERT INTO messages (sender_ip, ts, content, token, room_code, attach) VALUES " + ",".join(
+        ["(?,?,?,?,?,?)"] * rows
     )
 
 
+def _insert_messages(conn: sqlite3.Connection, batch: list):
+    with conn:
+        conn.execute("BEGIN")
+        for i in range(0, len(batch), MSG_INSERT_ROWS):
+            rows = batch[i : i + MSG_INSERT_ROWS]
+            conn.execute(_msg_insert_sql(len(rows)), [v for row in rows for v in row])
+
+
+def flush_messages():
+    """Write all queued messages in a single transaction, MSG_INSERT_ROWS per statement."""
+    with _msg_lock:
+        batch = list(_msg_queue)
+        _msg_queue.clear()
+    if not batch:
+        return
+    with _write_lock:
+        conn = get_write_conn()
+        try:
+            _insert_messages(conn, batch)
+        except ROW_DATA_ERRORS:
+            # a row that can't be bound or violates a constraint; retry one row per transaction so only that row is lost
+            for i, row in enumerate(batch):
+                try:
+                    _insert_messages(conn, [row])
+                except ROW_DATA_ERRORS:
+                    app.logger.warning("dropping unstorable message from %s", row[0])
+                except sqlite3.Error:
+                    _requeue_messages(batch[i:])
+                    raise
+        except sqlite3.Error:
+            # locked, disk full, ...: the transaction rolled back, so requeue the batch for the next pass
+            _requeue_messages(batch)
+            raise
+
+
+def _requeue_messages(rows: list):
+    """Put unwritten rows back at the front of the queue, dropping the oldest past MSG_QUEUE_MAX."""
+    with _msg_lock:
+        room = MSG_QUEUE_MAX - len(_msg_queue)
+        dropped = max(0, len(rows) - room)
+        _msg_queue.extendleft(reversed(rows[dropped:]))
+    if dropped:
+        app.logger.error("message queue full; dropped %d unwritten messages", dropped)
+
+
+def flush_pending():
+    """flush_messages for request handlers: a DB error is logged (rows stay queued) instead of failing the request."""
+    try:
+        flush_messages()
+    except sqlite3.Error:
+        app.logger.exception("message flush failed; serving what is already written")
+
+
+# whatever is still queued when the process exits normally
+atexit.register(flush_messages)
+
+
+def message_flusher():
+    while True:
+        socketio.sleep(MSG_FLUSH_INTERVAL)
+        try:
+            flush_messages()
+        except Exception:
+            # never let a DB error end the loop; nothing would be persisted until restart
+            app.logger.exception("message flush failed; retrying on the next pass")
+
+
 def recent_messages(limit: int = 200, room_code: Optional[str] = None):
+    """Return (sender_ip, ts, content, token, name, public_token, attach) rows, oldest first."""
+    # the inner query walks the ts index newest-first for LIMIT rows; the outer one re-sorts just those
     if room_code:
-        rows = db_run(
-            "SELECT sender_ip, ts, content, token FROM messages WHERE room_code=? ORDER BY ts DESC LIMIT ?",
+        return db_run(
+            "SELECT * FROM (SELECT m.sender_ip, m.ts, m.content, m.token, t.name, t.public_token, m.attach "
+            "FROM messages m LEFT JOIN tokens t ON t.token=m.token WHERE m.room_code=? "
+            "ORDER BY m.ts DESC LIMIT ?) ORDER BY ts",
             (room_code, limit),
             fetch=True,
         )
-    else:
-        rows = db_run(
-            "SELECT sender_ip, ts, content, token FROM messages ORDER BY ts DESC LIMIT ?",
-            (limit,),
-            fetch=True,
-        )
-    rows.reverse()
-    return rows
+    return db_run(
+        "SELECT * FROM (SELECT m.sender_ip, m.ts, m.content, m.token, t.name, t.public_token, m.attach "
+        "FROM messages m LEFT JOIN tokens t ON t.token=m.token ORDER BY m.ts DESC LIMIT ?) ORDER BY ts",
+        (limit,),
+        fetch=True,
+    )
 
 
 # --------------------------- ROOM HELPERS ------------------------
+ROOMS_CACHE_TTL = 5  # seconds the admin rooms table may lag behind
+_rooms_cache = {"exp": 0.0, "val": None}
+# rooms.code values known to exist, filled by load_mirrors; rooms are never deleted, so it only grows.
+# It can lag behind other server processes, so room_exists treats a miss as "ask the DB".
+_known_rooms = set()
+
+
 def create_room(code: str, name: str = "", host_token: str = ""):
     db_run(
-        "INSERT OR REPLACE INTO rooms (code, name, host_token, created_ts) VALUES (?,?,?,?)",
+        "INSERT INTO rooms (code, name, host_token, created_ts) VALUES (?,?,?,?) "
+        "ON CONFLICT(code) DO UPDATE SET name=excluded.name, host_token=excluded.host_token",
         (code, name or code, host_token, time.time()),
     )
+    _rooms_cache["exp"] = 0.0
+    _known_rooms.add(code)
 
 
 def get_all_rooms():
@@ -177,55 +470,127 @@ def get_all_rooms():
     return rows or []
 
 
+def cached_rooms():
+    """get_all_rooms(), reused for ROOMS_CACHE_TTL; create_room invalidates it."""
+    now = time.monotonic()
+    if now >= _rooms_cache["exp"]:
+        _rooms_cache.update(exp=now + ROOMS_CACHE_TTL, val=get_all_rooms())
+    return _rooms_cache["val"]
+
+
 def room_exists(code: str) -> bool:
-    rows = db_run("SELECT code FROM rooms WHERE code=?", (code,), fetch=True)
-    return bool(rows)
+    if not _mirrors_loaded:
+        load_mirrors()
+    if code in _known_rooms:
+        return True
+    # a miss isn't final: with CHAT_REDIS_URL another process may have created the room
+    if db_run("SELECT 1 FROM rooms WHERE code=?", (code,), fetch=True):
+        _known_rooms.add(code)
+        return True
+    return False
 
 
 # ---------------------------- BANS -------------------------------
+# in-memory mirror of the banned table; checked on every register when running as a single
+# process (see is_banned). Filled, with _known_rooms, by load_mirrors: from init_db or else on first use.
+_banned = set()
+_mirrors_loaded = False
+
+
+def load_mirrors():
+    """(Re)fill the in-memory mirrors of DB tables."""
+    global _mirrors_loaded
+    _banned.update(tok for (tok,) in db_run("SELECT token FROM banned", fetch="iter"))
+    _known_rooms.update(code for (code,) in db_run("SELECT code FROM rooms", fetch="iter"))
+    _mirrors_loaded = True
+
+
 def ban_token(token: str):
-    db_run("INSERT OR REPLACE INTO banned(token) VALUES (?)", (token,))
+    db_run("INSERT INTO banned(token) VALUES (?) ON CONFLICT(token) DO NOTHING", (token,))
+    _banned.add(token)
 
 
 def unban_token(token: str):
     db_run("DELETE FROM banned WHERE token=?", (token,))
+    _banned.discard(token)
 
 
 def is_banned(token: str) -> bool:
-    rows = db_run("SELECT token FROM banned WHERE token=?", (token,), fetch=True)
-    return bool(rows)
+    if MESSAGE_QUEUE:
+        # several processes share the DB; the set only sees bans made through this one
+        return bool(db_run("SELECT 1 FROM banned WHERE token=?", (token,), fetch=True))
+    if not _mirrors_loaded:
+        load_mirrors()  # no init_db at startup (e.g. run under gunicorn)
+    return token in _banned
 
 
 # ---------------------------- IP LINKS ---------------------------
-def ips_for_token(token: str) -> List[str]:
-    rows = db_run("SELECT DISTINCT sender_ip FROM messages WHERE token=?", (token,), fetch=True)
-    return [r[0] for r in rows] if rows else []
-
-
-def linked_names_for_ip(ip: str) -> List[str]:
-    rows = db_run(
-        "SELECT DISTINCT t.name FROM messages m JOIN tokens t ON t.token=m.token WHERE m.sender_ip=?", (ip,), fetch=True
-    )
-    return [r[0] for r in rows] if rows else []
-
-
 def last_non_anon_name_for_ip(ip: str) -> Optional[str]:
+    # LIKE is case-insensitive for ASCII, matching the old lower().startswith("anon") check
     rows = db_run(
-        "SELECT t.name FROM messages m JOIN tokens t ON t.token=m.token WHERE m.sender_ip=? ORDER BY m.ts DESC LIMIT 50",
+        "SELECT t.name FROM messages m JOIN tokens t ON t.token=m.token "
+        "WHERE m.sender_ip=? AND t.name != '' AND t.name NOT LIKE 'anon%' ORDER BY m.ts DESC LIMIT 1",
         (ip,),
         fetch=True,
     )
-    if rows:
-        for (nm,) in rows:
-            if nm and not nm.lower().startswith("anon"):
-                return nm
-    return None
+    return rows[0][0] if rows else None
 
 
 # --------------------------- LIVE MAPS ---------------------------
-sid_to_name = {}  # sid -> display name
-sid_to_token = {}  # sid -> secret token
-sid_to_room = {}  # sid -> room code or None
+SESSION_REAP_INTERVAL = 30  # seconds between reaper passes
+SESSION_STALE_AFTER = 300  # seconds without activity before a dead sid may be dropped
+
+
+@dataclass(slots=True)
+class LiveSession:
+    name: str
+    token: str
+    room: Optional[str]
+    last_seen: float  # time.monotonic()
+
+
+live_sessions: Dict[str, LiveSession] = {}  # sid -> session
+token_to_sids: Dict[str, set] = collections.defaultdict(set)  # inverse index for per-token actions
+
+
+def add_session(sid: str, sess: LiveSession):
+    old = live_sessions.get(sid)
+    if old is not None and old.token != sess.token:
+        _unindex_sid(sid, old.token)
+    live_sessions[sid] = sess
+    token_to_sids[sess.token].add(sid)
+
+
+def drop_session(sid: str):
+    sess = live_sessions.pop(sid, None)
+    if sess is not None:
+        _unindex_sid(sid, sess.token)
+
+
+def _unindex_sid(sid: str, token: str):
+    sids = token_to_sids.get(token)
+    if sids is not None:
+        sids.discard(sid)
+        if not sids:
+            del token_to_sids[token]
+
+
+def live_snapshot() -> List[Tuple[str, LiveSession]]:
+    """(sid, session) pairs copied in one step, safe to iterate while handlers add/drop sessions."""
+    # list() over dict items runs without a green-thread switch, so no lock is needed
+    return list(live_sessions.items())
+
+
+def session_reaper():
+    """Drop sessions whose disconnect handler never ran (e.g. abrupt drops under eventlet)."""
+    while True:
+        socketio.sleep(SESSION_REAP_INTERVAL)
+        cutoff = time.monotonic() - SESSION_STALE_AFTER
+        for sid, sess in live_snapshot():
+            # idle but still connected clients are kept
+            if sess.last_seen < cutoff and not socketio.server.manager.is_connected(sid, "/"):
+                drop_session(sid)
+
 
 # --------------------------- UTIL --------------------------------
 def get_client_ip():
@@ -235,24 +600,241 @@ def get_client_ip():
     return request.remote_addr
 
 
+# (public_token, name, HH:MM, text) -> rendered chat line; a bound str.format avoids per-line f-string setup
+chat_line = "<span class='user' data-pub='{}'>{}</span> - {} - {}".format
+
+ATTACH_TYPES = ("image", "audio", "file")
+
+
+def chat_entry(pub: str, name: str, hm: str, text: str, attach: Optional[dict] = None) -> Union[str, dict]:
+    """Text lines go out pre-rendered; attachments as {head, attach} for the client to build."""
+    # the client sets these with innerHTML, so every client-supplied field is escaped here
+    pub, name = escape(pub), escape(name)
+    if attach:
+        return {"head": chat_line(pub, name, hm, ""), "attach": attach}
+    return chat_line(pub, name, hm, escape(text))
+
+
+def clock_hm(ts: float) -> str:
+    """Local HH:MM for an epoch timestamp, without building a datetime."""
+    return _minute_hm(int(ts // 60))
+
+
+@lru_cache(maxsize=1024)
+def _minute_hm(minute: int) -> str:
+    # history rows cluster in the same few minutes, so most lookups skip localtime entirely
+    lt = time.localtime(minute * 60)
+    return f"{lt.tm_hour:02d}:{lt.tm_min:02d}"
+
+
+@lru_cache(maxsize=4096)
+def local_stamp(sec: int, fmt: str = "%Y-%m-%d %H:%M:%S") -> str:
+    """Local time string for a whole-second epoch; admin pages see many repeats."""
+    return time.strftime(fmt, time.localtime(sec))
+
+
+@lru_cache(maxsize=256)
+def date_filter_ts(value: str, days: int = 0) -> Optional[float]:
+    """Epoch of local midnight on an ISO date (plus `days`), or None if it doesn't parse."""
+    try:
+        return (datetime.fromisoformat(value) + timedelta(days=days)).timestamp()
+    except ValueError:
+        return None
+
+
+def upload_ext(filename: str) -> Optional[str]:
+    """Lower-cased extension of filename if it is an allowed upload type, else None."""
+    dot = filename.rfind(".")
+    ext = filename[dot:].lower() if dot >= 0 else ""
+    return ext if ext in ALLOWED_EXT else None
+
+
 def allowed_file(filename: str) -> bool:
-    ext = Path(filename).suffix.lower()
-    return ext in ALLOWED_EXT
+    return upload_ext(filename) is not None
+
+
+def upload_url(unique: str) -> str:
+    """URL stored in messages: root-relative unless UPLOAD_URL_BASE is set, so it survives host changes."""
+    if UPLOAD_URL_BASE:
+        return f"{UPLOAD_URL_BASE}/{unique}"
+    return url_for("uploaded_file", filename=unique)
+
+
+def external_url(url: str) -> str:
+    """Absolute form of a root-relative URL for JSON API responses."""
+    return request.host_url[:-1] + url if url.startswith("/") else url
+
+
+def clean_attach(data) -> Optional[dict]:
+    """Validate a client {type, url, name}; the url must name a file already in UPLOAD_DIR."""
+    if not isinstance(data, dict) or data.get("type") not in ATTACH_TYPES or not isinstance(data.get("url"), str):
+        return None
+    unique = data["url"].rsplit("/", 1)[-1]
+    if unique.startswith(".") or not allowed_file(unique) or not (UPLOAD_DIR / unique).is_file():
+        return None
+    name = data.get("name")
+    name = name[:200] if isinstance(name, str) and name else unique
+    return {"type": data["type"], "url": upload_url(unique), "name": name}
+
+
+def _fsync_upload(path: Path):
+    """Flush a saved upload to stable storage; runs on eventlet's native thread pool."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _store_spool(spool: UploadSpool, ext: str) -> str:
+    """Link a finished spool into UPLOAD_DIR under its content hash, return its upload_url."""
+    spool.flush()
+    unique = f"{spool.sha256.hexdigest()[:32]}{ext}"
+    path = UPLOAD_DIR / unique
+    os.chmod(spool.name, 0o644)  # temp files are created 0600
+    try:
+        os.link(spool.name, path)
+    except FileExistsError:
+        pass  # identical content already stored
+    else:
+        # the file is readable as soon as it is linked; only durability is deferred
+        eventlet.spawn_n(tpool.execute, _fsync_upload, path)
+    return upload_url(unique)
 
 
 def save_upload(file_storage):
-    """Save an uploaded FileStorage to disk in UPLOAD_DIR, return public URL path."""
-    filename = secure_filename(file_storage.filename)
-    if not filename:
-        filename = "file"
-    ext = Path(filename).suffix.lower()
-    if ext not in ALLOWED_EXT:
+    """Store a multipart upload (already spooled by ChatRequest), return public URL."""
+    ext = upload_ext(file_storage.filename or "")
+    if not ext:
         # allow saving but mark extension — block by default
         raise ValueError("file type not allowed")
-    unique = f"{int(time.time())}_{uuid.uuid4().hex[:8]}_{filename}"
-    path = UPLOAD_DIR / unique
-    file_storage.save(path)
-    return url_for("uploaded_file", filename=unique, _external=True)
+    return _store_spool(file_storage.stream, ext)
+
+
+def save_upload_stream(stream, filename: str):
+    """Copy a raw request body to disk in UPLOAD_CHUNK_SIZE pieces, return public URL."""
+    ext = upload_ext(filename)
+    if not ext:
+        raise ValueError("file type not allowed")
+    spool = UploadSpool()
+    try:
+        shutil.copyfileobj(stream, spool, UPLOAD_CHUNK_SIZE)
+        if not spool.tell():
+            # also what a chunked body looks like when the WSGI server doesn't mark its input terminated
+            raise ValueError("empty upload")
+        return _store_spool(spool, ext)
+    finally:
+        spool.close()
+
+
+def _chunk_dir(upload_id: str) -> Path:
+    if not upload_id or len(upload_id) > 64 or any(c not in "0123456789abcdef" for c in upload_id):
+        raise ValueError("bad uploadId")
+    return CHUNK_DIR / upload_id
+
+
+def _received_parts(part_dir: Path) -> List[int]:
+    if not part_dir.is_dir():
+        return []
+    return sorted(int(p.name) for p in part_dir.iterdir() if p.name.isdigit())
+
+
+def _sweep_stale_chunks():
+    """Drop part dirs of uploads that were abandoned more than CHUNK_TTL ago."""
+    cutoff = time.time() - CHUNK_TTL
+    for d in CHUNK_DIR.iterdir():
+        try:
+            if d.stat().st_mtime < cutoff:
+                shutil.rmtree(d, ignore_errors=True)
+        except FileNotFoundError:
+            pass
+
+
+def save_upload_chunk(upload_id: str, idx: int, total: int, stream):
+    """Write one part of a resumable upload; the part only appears once complete."""
+    if not 0 <= idx < total <= CHUNK_MAX_PARTS:
+        raise ValueError("bad chunk index")
+    part_dir = _chunk_dir(upload_id)
+    if not part_dir.is_dir():
+        CHUNK_DIR.mkdir(exist_ok=True)
+        _sweep_stale_chunks()
+        part_dir.mkdir(exist_ok=True)
+    # bound the copy itself: a chunked-encoding request carries no Content-Length to check up front
+    others = sum(p.stat().st_size for p in part_dir.iterdir() if p.name.isdigit() and p.name != str(idx))
+    limit = min(CHUNK_PART_SIZE, MAX_CONTENT_LENGTH - others)
+    if limit <= 0:
+        raise RequestEntityTooLarge("upload too large")
+    tmp = part_dir / f"{idx}.part"
+    written = 0
+    try:
+        with open(tmp, "wb") as out:
+            while True:
+                buf = stream.read(min(UPLOAD_CHUNK_SIZE, limit + 1 - written))
+                if not buf:
+                    break
+                written += len(buf)
+                if written > limit:
+                    raise RequestEntityTooLarge("chunk too large")
+                out.write(buf)
+        if not written:
+            # also what a chunked body looks like when the WSGI server doesn't mark its input terminated
+            raise ValueError("empty chunk")
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    os.replace(tmp, part_dir / str(idx))
+
+
+def finalize_chunked_upload(upload_id: str, total: int, filename: str):
+    """Join the parts of a resumable upload in order, return public URL."""
+    ext = upload_ext(filename)
+    if not ext:
+        raise ValueError("file type not allowed")
+    part_dir = _chunk_dir(upload_id)
+    if total < 1 or _received_parts(part_dir) != list(range(total)):
+        raise ValueError("upload incomplete")
+    spool = UploadSpool()
+    try:
+        for idx in range(total):
+            with open(part_dir / str(idx), "rb") as part:
+                shutil.copyfileobj(part, spool, UPLOAD_CHUNK_SIZE)
+        if spool.tell() > MAX_CONTENT_LENGTH:
+            raise ValueError("file too large")
+        url = _store_spool(spool, ext)
+    finally:
+        spool.close()
+    shutil.rmtree(part_dir, ignore_errors=True)
+    return url
+
+
+# ------------------------ OUTBOUND BATCHING -----------------------
+# chat lines are coalesced per room and sent as one "chat_batch" frame
+CHAT_FLUSH_INTERVAL = 0.01  # seconds
+CHAT_BATCH_MAX = 64
+_pending_lines: Dict[Optional[str], list] = {}  # room (None = everyone) -> queued chat entries
+
+
+def queue_chat_line(room: Optional[str], line: Union[str, dict]):
+    lines = _pending_lines.get(room)
+    if lines is None:
+        _pending_lines[room] = [line]
+        socketio.start_background_task(_flush_chat_lines, room, CHAT_FLUSH_INTERVAL)
+    else:
+        lines.append(line)
+        if len(lines) >= CHAT_BATCH_MAX:
+            _flush_chat_lines(room)
+
+
+def _flush_chat_lines(room: Optional[str], delay: float = 0):
+    if delay:
+        socketio.sleep(delay)
+    lines = _pending_lines.pop(room, None)
+    if not lines:
+        return
+    if room:
+        socketio.emit("chat_batch", lines, room=room)
+    else:
+        socketio.emit("chat_batch", lines)
 
 
 # ------------------------ SOCKET.IO HANDLERS -----------------------
@@ -278,11 +860,11 @@ def on_register(data):
             token = provided_token
         else:
             name = req_name or "anon"
-            token = str(uuid.uuid4())
+            token = secrets.token_hex(16)
             ensure_token_record(token, name)
     else:
         name = req_name or "anon"
-        token = str(uuid.uuid4())
+        token = secrets.token_hex(16)
         ensure_token_record(token, name)
 
     # if anon-ish, try to re-associate by IP
@@ -297,58 +879,62 @@ def on_register(data):
         return
 
     sid = request.sid
-    sid_to_name[sid] = name
-    sid_to_token[sid] = token
-    sid_to_room[sid] = None
+    sess = LiveSession(name, token, None, time.monotonic())
+    add_session(sid, sess)
 
     # join room if requested and exists
     if desired_room and room_exists(desired_room):
-        sid_to_room[sid] = desired_room
+        sess.room = desired_room
         sio_join(desired_room)
 
     pub = get_public_by_token(token)
     emit("welcome", {"name": name, "token": token, "public_token": pub})
 
     # send recent history scoped to room
-    history = recent_messages(limit=200, room_code=sid_to_room.get(sid))
-    lines = []
-    for sender_ip, ts, txt, tok in history:
-        nickname = get_name_by_token(tok) or "anon"
-        pubt = get_public_by_token(tok) or "?"
-        when = datetime.fromtimestamp(ts).strftime("%H:%M")
-        lines.append(f"<span class='user' data-pub='{pubt}'>{nickname}</span> - {when} - {txt}")
+    flush_pending()
+    history = recent_messages(limit=200, room_code=sess.room)
+    lines = [
+        chat_entry(pubt or "?", nickname or "anon", clock_hm(ts), txt, json.loads(attach) if attach else None)
+        for _ip, ts, txt, _tok, nickname, pubt, attach in history
+    ]
     emit("history", lines)
 
 
 @socketio.on("msg")
 def on_msg(data):
-    # data: string or {text, room}
-    text = data if isinstance(data, str) else data.get("text", "")
-    room = None
-    if isinstance(data, dict):
-        room = data.get("room")
-    sid = request.sid
-    token = sid_to_token.get(sid)
-    name = sid_to_name.get(sid, "anon")
+    # data: string, {text, room} or {attach: {type, url, name}, room}
+    if isinstance(data, str):
+        data = {"text": data}
+    elif not isinstance(data, dict):
+        return
+    text, room, attach = data.get("text", ""), data.get("room") or None, None
+    # these are queued for SQLite and broadcast as-is: only plain, bounded strings get through
+    if not isinstance(text, str) or not (room is None or (isinstance(room, str) and len(room) <= MAX_ROOM_LEN)):
+        return
+    text = text[:MAX_MSG_LEN]
+    if "attach" in data:
+        attach = clean_attach(data["attach"])
+        if not attach:
+            return
+        text = f"[{attach['type']}] {attach['url']}"  # readable form for the admin logs
+    sess = live_sessions.get(request.sid)
+    if sess:
+        sess.last_seen = time.monotonic()
+        token, name = sess.token, sess.name
+    else:
+        token, name = None, "anon"
     client_ip = get_client_ip()
     # store
-    store_message(sender_ip=client_ip, content=text, token=token, room_code=room)
+    store_message(sender_ip=client_ip, content=text, token=token, room_code=room, attach=attach)
     # broadcast
     pub = get_public_by_token(token) or "?"
-    now = datetime.now().strftime("%H:%M")
-    line = f"<span class='user' data-pub='{pub}'>{name}</span> - {now} - {text}"
-    if room:
-        emit("chat_line", line, room=room)
-    else:
-        emit("chat_line", line, broadcast=True)
+    now = clock_hm(time.time())
+    queue_chat_line(room, chat_entry(pub, name, now, text, attach))
 
 
 @socketio.on("disconnect")
 def on_disconnect():
-    sid = request.sid
-    sid_to_name.pop(sid, None)
-    sid_to_token.pop(sid, None)
-    sid_to_room.pop(sid, None)
+    drop_session(request.sid)
 
 
 # --------------------------- ADMIN HELPERS ------------------------
@@ -356,17 +942,40 @@ def admin_required():
     return session.get("admin") is True
 
 
+# endpoints under /admin reachable without a session
+ADMIN_PUBLIC_ENDPOINTS = frozenset({"admin_login", "admin_logout"})
+
+
+@app.before_request
+def _admin_guard():
+    if request.path.startswith("/admin") and request.endpoint not in ADMIN_PUBLIC_ENDPOINTS and not admin_required():
+        return redirect(url_for("admin_login"))
+
+
 # ------------------------- ADMIN TEMPLATES ------------------------
-ADMIN_LOGIN_HTML = """
+# every admin page extends one layout: the shared head/style, heading and Back links
+# are parsed and compiled once instead of once per page
+ADMIN_LAYOUT_HTML = """
 <!doctype html>
-<html>
-<head><title>Admin Login</title>
-<style>body{font-family:Arial;margin:20px}form{max-width:360px}input{display:block;margin:8px 0;padding:8px;width:100%}button{padding:8px}</style></head>
+<html><head><title>Admin • {% block title %}{% endblock %}</title>
+<style>body{font-family:Arial;margin:20px}table{border-collapse:collapse;width:100%}th,td{border:1px solid #ddd;padding:8px}.code{font-family:monospace;background:#f9f9f9;padding:2px 6px;border-radius:4px}{% block style %}{% endblock %}</style></head>
 <body>
-  <h2>Admin Login</h2>
+<h2>{{ self.title() }}</h2>
+{% block nav %}<p><a href="{{ cached_url('admin_dashboard') }}">⬅ Back</a></p>{% endblock %}
+{% block body %}{% endblock %}
+{% block footer %}{{ self.nav() }}{% endblock %}
+</body></html>
+"""
+
+ADMIN_LOGIN_HTML = """
+{% extends layout %}
+{% block title %}Login{% endblock %}
+{% block style %}form{max-width:360px}input{display:block;margin:8px 0;padding:8px;width:100%}button{padding:8px}{% endblock %}
+{% block nav %}{% endblock %}
+{% block body %}
   {% with msgs = get_flashed_messages() %}
     {% if msgs %}
-      <div style="color:red">{{ msgs[0] }}</div>
+      <div style="color:red">{{ msgs[0]|e }}</div>
     {% endif %}
   {% endwith %}
   <form method="post">
@@ -374,60 +983,41 @@ ADMIN_LOGIN_HTML = """
     <input name="password" type="password" placeholder="password" required />
     <button type="submit">Login</button>
   </form>
-  <p><a href="{{ url_for('index') }}">Back to chat</a></p>
-</body>
-</html>
+{% endblock %}
+{% block footer %}<p><a href="{{ cached_url('index') }}">Back to chat</a></p>{% endblock %}
 """
 
 ADMIN_MENU_HTML = """
-<!doctype html>
-<html><head><title>Admin Dashboard</title>
-<style>body{font-family:Arial;margin:20px}a.btn{display:inline-block;padding:8px 12px;margin:6px;border:1px solid #999;border-radius:6px;text-decoration:none;color:black}</style></head>
-<body>
-  <h2>Admin Dashboard</h2>
+{% extends layout %}
+{% block title %}Dashboard{% endblock %}
+{% block style %}a.btn{display:inline-block;padding:8px 12px;margin:6px;border:1px solid #999;border-radius:6px;text-decoration:none;color:black}{% endblock %}
+{% block nav %}{% endblock %}
+{% block body %}
   <p>
-    <a class="btn" href="{{ url_for('admin_view') }}">View Users & Rooms</a>
-    <a class="btn" href="{{ url_for('admin_manage') }}">Manage Users</a>
-    <a class="btn" href="{{ url_for('admin_logs') }}">Logs</a>
-    <a class="btn" href="{{ url_for('admin_logout') }}">Logout</a>
+    <a class="btn" href="{{ cached_url('admin_view') }}">View Users & Rooms</a>
+    <a class="btn" href="{{ cached_url('admin_manage') }}">Manage Users</a>
+    <a class="btn" href="{{ cached_url('admin_logs') }}">Logs</a>
+    <a class="btn" href="{{ cached_url('admin_logout') }}">Logout</a>
   </p>
-  <p><a href="{{ url_for('index') }}">⬅ Back to Chat</a></p>
-</body></html>
+{% endblock %}
+{% block footer %}<p><a href="{{ cached_url('index') }}">⬅ Back to Chat</a></p>{% endblock %}
 """
 
 ADMIN_VIEW_HTML = """
-<!doctype html>
-<html><head><title>Admin • View</title>
-<style>body{font-family:Arial;margin:20px}table{border-collapse:collapse;width:100%}th,td{border:1px solid #ddd;padding:8px}.code{font-family:monospace;background:#f9f9f9;padding:2px 6px;border-radius:4px}</style></head>
-<body>
-<h2>Users & Rooms</h2>
-<p><a href="{{ url_for('admin_dashboard') }}">⬅ Back</a></p>
-
+{% extends layout %}
+{% block title %}Users & Rooms{% endblock %}
+{% block body %}
 <h3>Live Participants</h3>
 <table>
 <tr><th>sid (short)</th><th>Name</th><th>Public</th><th>Secret</th><th>IP(s)</th><th>Room</th></tr>
-{% for sid, v in live.items() %}
-<tr>
-  <td class="code">{{ sid[:8] }}</td>
-  <td>{{ v.name }}</td>
-  <td class="code">{{ v.public or '-' }}</td>
-  <td class="code">{{ v.secret or '-' }}</td>
-  <td>{{ v.ips|join(', ') if v.ips else '-' }}</td>
-  <td>{{ v.room or 'Lobby' }}</td>
-</tr>
+{% for row in live_rows %}{{ row }}
 {% endfor %}
 </table>
 
 <h3>Registered Users</h3>
 <table>
 <tr><th>Name</th><th>Public</th><th>Secret</th><th>IPs</th></tr>
-{% for name, secret, public, ips in users %}
-<tr>
-  <td>{{ name }}</td>
-  <td class="code">{{ public }}</td>
-  <td class="code">{{ secret }}</td>
-  <td>{{ ips|join(', ') if ips else '-' }}</td>
-</tr>
+{% for row in user_rows %}{{ row }}
 {% endfor %}
 </table>
 
@@ -435,7 +1025,7 @@ ADMIN_VIEW_HTML = """
 <table>
 <tr><th>IP</th><th>Usernames</th></tr>
 {% for ip, names in linked.items() %}
-<tr><td>{{ ip }}</td><td>{{ names|join(', ') }}</td></tr>
+<tr><td>{{ ip|e }}</td><td>{{ names|join(', ')|e }}</td></tr>
 {% endfor %}
 </table>
 
@@ -444,35 +1034,31 @@ ADMIN_VIEW_HTML = """
 <tr><th>Code</th><th>Name</th><th>Host</th><th>Created</th><th>Live participants</th></tr>
 {% for r in rooms %}
 <tr>
-  <td class="code">{{ r[0] }}</td>
-  <td>{{ r[1] }}</td>
-  <td class="code">{{ r[2] or '-' }}</td>
-  <td>{{ (r[3] and (datetime.fromtimestamp(r[3]).strftime('%Y-%m-%d %H:%M'))) or '-' }}</td>
+  <td class="code">{{ r[0]|e }}</td>
+  <td>{{ r[1]|e }}</td>
+  <td class="code">{{ (r[2] or '-')|e }}</td>
+  <td>{{ r[3] }}</td>
   <td>
-    {% for p in (live_by_room.get(r[0]) or []) %}
-      <div>{{ p[0] }} <small class="code">{{ p[1][:8] }}</small></div>
+    {% for p in r[4] %}
+      <div>{{ p[0]|e }} <small class="code">{{ p[1][:8]|e }}</small></div>
     {% endfor %}
   </td>
 </tr>
 {% endfor %}
 </table>
-
-<p><a href="{{ url_for('admin_dashboard') }}">⬅ Back</a></p>
-</body></html>
+{% endblock %}
 """
 
 ADMIN_MANAGE_HTML = """
-<!doctype html>
-<html><head><title>Admin • Manage</title><style>body{font-family:Arial;margin:20px}table{border-collapse:collapse;width:100%}th,td{border:1px solid #ddd;padding:8px}</style></head><body>
-<h2>Manage Users</h2>
-<p><a href="{{ url_for('admin_dashboard') }}">⬅ Back</a></p>
-
+{% extends layout %}
+{% block title %}Manage Users{% endblock %}
+{% block body %}
 <h3>Ban / Unban tokens</h3>
-<form method="post" action="{{ url_for('admin_ban') }}">
+<form method="post" action="{{ cached_url('admin_ban') }}">
   <label>Token to ban: <input name="token" placeholder="secret token" required/></label>
   <button type="submit">Ban</button>
 </form>
-<form method="post" action="{{ url_for('admin_unban') }}" style="margin-top:8px">
+<form method="post" action="{{ cached_url('admin_unban') }}" style="margin-top:8px">
   <label>Token to unban: <input name="token" placeholder="secret token" required/></label>
   <button type="submit">Unban</button>
 </form>
@@ -480,69 +1066,105 @@ ADMIN_MANAGE_HTML = """
 <h3>Active sessions (kick / move)</h3>
 <table>
 <tr><th>sid</th><th>name</th><th>token</th><th>room</th><th>actions</th></tr>
-{% for sid, v in live.items() %}
+{% for sid, name, secret, room in live %}
 <tr>
   <td class="code">{{ sid[:8] }}</td>
-  <td>{{ v.name }}</td>
-  <td class="code">{{ v.secret }}</td>
-  <td>{{ v.room or 'Lobby' }}</td>
+  <td>{{ name|e }}</td>
+  <td class="code">{{ secret|e }}</td>
+  <td>{{ (room or 'Lobby')|e }}</td>
   <td>
-    <form style="display:inline" method="post" action="{{ url_for('admin_kick') }}">
+    <form style="display:inline" method="post" action="{{ cached_url('admin_kick') }}">
       <input type="hidden" name="sid" value="{{ sid }}"/><button type="submit">Kick</button>
     </form>
-    <form style="display:inline" method="post" action="{{ url_for('admin_move') }}">
+    <form style="display:inline" method="post" action="{{ cached_url('admin_move') }}">
       <input type="hidden" name="sid" value="{{ sid }}"/><input name="room" placeholder="ROOMCODE"/><button type="submit">Move</button>
     </form>
   </td>
 </tr>
 {% endfor %}
 </table>
-
-<p><a href="{{ url_for('admin_dashboard') }}">⬅ Back</a></p>
-</body></html>
+{% endblock %}
 """
 
 ADMIN_LOGS_HTML = """
-<!doctype html>
-<html><head><title>Admin • Logs</title>
-<style>body{font-family:Arial;margin:20px}form.inline{display:flex;gap:8px;align-items:center;margin-bottom:12px}pre{white-space:pre-wrap;background:#f9f9f9;padding:12px;border:1px solid #ddd}</style></head>
-<body>
-<h2>Message Logs</h2>
-<p><a href="{{ url_for('admin_dashboard') }}">⬅ Back</a></p>
-
-<form method="get" action="{{ url_for('admin_logs') }}" class="inline">
-  <input name="q" placeholder="search text or filename" value="{{ q or '' }}"/>
-  <input name="room" placeholder="room" value="{{ room or '' }}"/>
-  <input name="token" placeholder="token" value="{{ token or '' }}"/>
-  <input name="ip" placeholder="ip" value="{{ ip or '' }}"/>
-  <label>from <input type="date" name="from" value="{{ date_from or '' }}"/></label>
-  <label>to <input type="date" name="to" value="{{ date_to or '' }}"/></label>
+{% extends layout %}
+{% block title %}Message Logs{% endblock %}
+{% block style %}form.inline{display:flex;gap:8px;align-items:center;margin-bottom:12px}pre{white-space:pre-wrap;background:#f9f9f9;padding:12px;border:1px solid #ddd}{% endblock %}
+{% block body %}
+<form method="get" action="{{ cached_url('admin_logs') }}" class="inline">
+  <input name="q" placeholder="search text or filename" value="{{ q|e }}"/>
+  <input name="room" placeholder="room" value="{{ room|e }}"/>
+  <input name="token" placeholder="token" value="{{ token|e }}"/>
+  <input name="ip" placeholder="ip" value="{{ ip|e }}"/>
+  <label>from <input type="date" name="from" value="{{ date_from|e }}"/></label>
+  <label>to <input type="date" name="to" value="{{ date_to|e }}"/></label>
   <button type="submit">Filter</button>
 </form>
 
-<div>Showing page {{ page }} / {{ total_pages }} ({{ total }} results)</div>
+<div>{{ total }} results</div>
 
 <pre>
-{% for ip, ts, content, token, room in results %}
-[{{ datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S') }}] IP: {{ ip }} | Room: {{ room or '-' }} | Token: {{ token }}
-{{ content }}
-
-{% endfor %}
-</pre>
+{{ log_body }}</pre>
 
 <div>
-{% if page > 1 %}
-  <a href="{{ url_for('admin_logs') }}?{{ qs_prev }}">⬅ Prev</a>
+{% if qs_prev %}
+  <a href="{{ cached_url('admin_logs') }}?{{ qs_prev }}">⬅ Newer</a>
 {% endif %}
-{% if page < total_pages %}
-  <a href="{{ url_for('admin_logs') }}?{{ qs_next }}">Next ➡</a>
+{% if qs_next %}
+  <a href="{{ cached_url('admin_logs') }}?{{ qs_next }}">Older ➡</a>
 {% endif %}
 </div>
-
-<p><a href="{{ url_for('admin_dashboard') }}">⬅ Back</a></p>
-</body></html>
+{% endblock %}
 """
 
+# compiled once at import; render_template_string would re-parse the source on every request.
+# Admin templates compile with autoescape off, so nothing is escaped implicitly: names, tokens,
+# room codes, IPs, flashes and filter values all come from clients and must be written {{ x|e }};
+# prebuilt rows and log_body are Markup that already went through escape().
+ADMIN_JINJA_ENV = app.jinja_env.overlay(autoescape=False)
+ADMIN_LAYOUT_TPL = ADMIN_JINJA_ENV.from_string(ADMIN_LAYOUT_HTML)
+
+
+def cached_url(endpoint: str) -> str:
+    """url_for for argument-less endpoints, resolved once per request (kick/move forms repeat per row)."""
+    urls = g.setdefault("_url_cache", {})
+    url = urls.get(endpoint)
+    if url is None:
+        url = urls[endpoint] = url_for(endpoint)
+    return url
+
+
+def admin_template(source: str):
+    return ADMIN_JINJA_ENV.from_string(source, globals={"layout": ADMIN_LAYOUT_TPL, "cached_url": cached_url})
+
+
+ADMIN_LOGIN_TPL = admin_template(ADMIN_LOGIN_HTML)
+ADMIN_MENU_TPL = admin_template(ADMIN_MENU_HTML)
+ADMIN_VIEW_TPL = admin_template(ADMIN_VIEW_HTML)
+ADMIN_MANAGE_TPL = admin_template(ADMIN_MANAGE_HTML)
+ADMIN_LOGS_TPL = admin_template(ADMIN_LOGS_HTML)
+# view/manage/logs go out with stream_template, so table rows are flushed as they render
+
+# the big admin tables are rendered a row at a time in Python: one Markup string per row
+# instead of a Jinja lookup + autoescape per cell. Every field still goes through escape().
+LIVE_ROW_HTML = (
+    '<tr><td class="code">{}</td><td>{}</td><td class="code">{}</td>'
+    '<td class="code">{}</td><td>{}</td><td>{}</td></tr>'
+).format
+LOG_ENTRY = "[{}] IP: {} | Room: {} | Token: {}\n{}\n\n".format
+USER_ROW_HTML = '<tr><td>{}</td><td class="code">{}</td><td class="code">{}</td><td>{}</td></tr>'.format
+
+
+def live_row(sid: str, name: str, secret: str, public: Optional[str], ips: List[str], room: Optional[str]) -> Markup:
+    return Markup(LIVE_ROW_HTML(
+        escape(sid[:8]), escape(name), escape(public or "-"), escape(secret or "-"),
+        escape(", ".join(ips) if ips else "-"), escape(room or "Lobby"),
+    ))
+
+
+def user_row(name: str, secret: str, public: str, ips: List[str]) -> Markup:
+    return Markup(USER_ROW_HTML(escape(name), escape(public), escape(secret), escape(", ".join(ips) if ips else "-")))
+
 # ------------------------- ADMIN ROUTES ---------------------------
 @app.route("/admin", methods=["GET", "POST"])
 def admin_login():
@@ -554,80 +1176,95 @@ def admin_login():
             return redirect(url_for("admin_dashboard"))
         flash("Invalid credentials")
         return redirect(url_for("admin_login"))
-    return render_template_string(ADMIN_LOGIN_HTML)
+    return render_template(ADMIN_LOGIN_TPL)
 
 
 @app.route("/admin/dashboard")
 def admin_dashboard():
-    if not admin_required():
-        return redirect(url_for("admin_login"))
-    return render_template_string(ADMIN_MENU_HTML)
+    return render_template(ADMIN_MENU_TPL)
 
 
 @app.route("/admin/view")
 def admin_view():
-    if not admin_required():
-        return redirect(url_for("admin_login"))
-    # registered users + ips
-    users = db_run("SELECT name, token, public_token FROM tokens", fetch=True) or []
-    ip_pairs = db_run("SELECT DISTINCT sender_ip, token FROM messages", fetch=True) or []
+    # registered users + ips; the pair scans are folded into dicts straight off the cursor
+    ip_pairs = db_run("SELECT DISTINCT sender_ip, token FROM messages", fetch="iter")
     token_to_ips = {}
     for ip, tok in ip_pairs:
         token_to_ips.setdefault(tok, []).append(ip)
-    users_with_ips = [(n, t, p, token_to_ips.get(t, [])) for n, t, p in users]
-
-    # linked names by ip
-    ips = db_run("SELECT DISTINCT sender_ip FROM messages", fetch=True) or []
+    # rendered before streaming starts: a lazy generator would hold a pooled reader (and its WAL
+    # snapshot) open for as long as a slow client takes to receive the page
+    user_rows = []
+    public_by_token = {}
+    for n, t, p in db_run("SELECT name, token, public_token FROM tokens", fetch="iter"):
+        user_rows.append(user_row(n, t, p, token_to_ips.get(t, [])))
+        public_by_token[t] = p
+
+    # linked names by ip, in one pass instead of a query per ip
+    name_pairs = db_run(
+        "SELECT DISTINCT m.sender_ip, t.name FROM messages m LEFT JOIN tokens t ON t.token=m.token", fetch="iter"
+    )
     linked = {}
-    for (ip,) in ips:
-        linked[ip] = linked_names_for_ip(ip)
-
-    rooms = get_all_rooms()
+    for ip, nm in name_pairs:
+        names = linked.setdefault(ip, [])
+        if nm is not None:
+            names.append(nm)
 
-    live = {}
-    for sid, name in sid_to_name.items():
-        secret = sid_to_token.get(sid)
-        public = get_public_by_token(secret)
-        ip_list = ips_for_token(secret)
-        live[sid] = type("V", (), {"name": name, "secret": secret, "public": public, "ips": ip_list, "room": sid_to_room.get(sid)})
+    # flat (sid, name, secret, room) tuples; no per-row object
+    live = [(sid, sess.name, sess.token, sess.room) for sid, sess in live_snapshot()]
 
     live_by_room = {}
-    for sid, v in live.items():
-        room = v.room or "Lobby"
-        live_by_room.setdefault(room, []).append((v.name, v.secret or ""))
-
-    return render_template_string(
-        ADMIN_VIEW_HTML, users=users_with_ips, linked=linked, rooms=rooms, live=live, live_by_room=live_by_room, datetime=datetime
+    for sid, name, secret, room in live:
+        live_by_room.setdefault(room or "Lobby", []).append((name, secret or ""))
+
+    # each room row carries its own participant list, so the template does no per-row lookup
+    rooms = [
+        (code, name, host, local_stamp(int(created), "%Y-%m-%d %H:%M") if created else "-", live_by_room.get(code, ()))
+        for code, name, host, created in cached_rooms()
+    ]
+
+    return stream_template(
+        ADMIN_VIEW_TPL,
+        user_rows=user_rows,
+        linked=linked,
+        rooms=rooms,
+        live_rows=[
+            live_row(sid, name, secret, public_by_token.get(secret), token_to_ips.get(secret), room)
+            for sid, name, secret, room in live
+        ],
     )
 
 
 @app.route("/admin/manage")
 def admin_manage():
-    if not admin_required():
-        return redirect(url_for("admin_login"))
-    live = {}
-    for sid, name in sid_to_name.items():
-        secret = sid_to_token.get(sid)
-        public = get_public_by_token(secret)
-        ip_list = ips_for_token(secret)
-        live[sid] = type("V", (), {"name": name, "secret": secret, "public": public, "ips": ip_list, "room": sid_to_room.get(sid)})
-    return render_template_string(ADMIN_MANAGE_HTML, live=live)
+    # this page only shows name, token and room, so skip the public-token and per-token IP lookups
+    live = [(sid, sess.name, sess.token, sess.room) for sid, sess in live_snapshot()]
+    return stream_template(ADMIN_MANAGE_TPL, live=live)
 
 
 @app.route("/admin/logs")
 def admin_logs():
-    if not admin_required():
-        return redirect(url_for("admin_login"))
 
-    # filtering & pagination
+    # filtering & keyset pagination on (ts, id), newest first
     q = request.args.get("q", "").strip()
     room = request.args.get("room", "").strip()
     token = request.args.get("token", "").strip()
     ip = request.args.get("ip", "").strip()
     date_from = request.args.get("from", "").strip()
     date_to = request.args.get("to", "").strip()
-    page = max(1, int(request.args.get("page", "1")))
-    per_page = 30
+    try:
+        per_page = min(max(int(request.args.get("limit", 30)), 1), 500)
+    except ValueError:
+        per_page = 30
+    count_cap = 1000
+
+    def cursor_arg(prefix):
+        try:
+            return float(request.args[prefix + "_ts"]), int(request.args[prefix + "_id"])
+        except (KeyError, ValueError):
+            return None
+
+    before = cursor_arg("before")
+    after = None if before else cursor_arg("after")
 
     # build where
     where_clauses = []
@@ -644,46 +1281,70 @@ def admin_logs():
     if ip:
         where_clauses.append("sender_ip=?")
         params.append(ip)
-    if date_from:
-        try:
-            dt = datetime.strptime(date_from, "%Y-%m-%d")
-            where_clauses.append("ts >= ?")
-            params.append(time.mktime(dt.timetuple()))
-        except Exception:
-            pass
-    if date_to:
-        try:
-            dt = datetime.strptime(date_to, "%Y-%m-%d") + timedelta(days=1)
-            where_clauses.append("ts < ?")
-            params.append(time.mktime(dt.timetuple()))
-        except Exception:
-            pass
+    from_ts = date_filter_ts(date_from) if date_from else None
+    if from_ts is not None:
+        where_clauses.append("ts >= ?")
+        params.append(from_ts)
+    to_ts = date_filter_ts(date_to, days=1) if date_to else None
+    if to_ts is not None:
+        where_clauses.append("ts < ?")
+        params.append(to_ts)
 
     where_sql = ("WHERE " + " AND ".join(where_clauses)) if where_clauses else ""
-    count_row = db_run(f"SELECT COUNT(*) FROM messages {where_sql}", tuple(params), fetch=True)
+    flush_pending()
+    # capped count: stop scanning once we know there are more than count_cap matches
+    count_row = db_run(
+        f"SELECT COUNT(*) FROM (SELECT 1 FROM messages {where_sql} LIMIT ?)", tuple(params) + (count_cap + 1,), fetch=True
+    )
     total = count_row[0][0] if count_row else 0
-    total_pages = max(1, math.ceil(total / per_page))
-    offset = (page - 1) * per_page
+    total_label = f"{count_cap}+" if total > count_cap else str(total)
+
+    page_clauses = list(where_clauses)
+    page_params = list(params)
+    if before:
+        page_clauses.append("(ts, id) < (?, ?)")
+        page_params.extend(before)
+    elif after:
+        page_clauses.append("(ts, id) > (?, ?)")
+        page_params.extend(after)
+    page_sql = ("WHERE " + " AND ".join(page_clauses)) if page_clauses else ""
+    order = "ASC" if after else "DESC"
+    # fetch one extra row to learn whether another page exists in that direction
     rows = db_run(
-        f"SELECT sender_ip, ts, content, token, room_code FROM messages {where_sql} ORDER BY ts DESC LIMIT ? OFFSET ?",
-        tuple(params) + (per_page, offset),
+        f"SELECT sender_ip, ts, content, token, room_code, id FROM messages {page_sql} ORDER BY ts {order}, id {order} LIMIT ?",
+        tuple(page_params) + (per_page + 1,),
         fetch=True,
     ) or []
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if after:
+        rows.reverse()
+    has_newer = more if after else bool(before)
+    has_older = more if not after else True
+
     # render with next/prev qs
     from urllib.parse import urlencode
 
-    def qs_for(p):
-        qd = {"q": q, "room": room, "token": token, "ip": ip, "from": date_from, "to": date_to, "page": p}
-        return urlencode({k: v for k, v in qd.items() if v})
-
-    qs_prev = qs_for(page - 1)
-    qs_next = qs_for(page + 1)
-    return render_template_string(
-        ADMIN_LOGS_HTML,
-        results=rows,
-        page=page,
-        total=total,
-        total_pages=total_pages,
+    def qs_for(prefix, row):
+        qd = {"q": q, "room": room, "token": token, "ip": ip, "from": date_from, "to": date_to}
+        qd = {k: v for k, v in qd.items() if v}
+        if per_page != 30:
+            qd["limit"] = per_page
+        qd[prefix + "_ts"] = repr(row[1])
+        qd[prefix + "_id"] = row[5]
+        return urlencode(qd)
+
+    qs_prev = qs_for("after", rows[0]) if rows and has_newer else None
+    qs_next = qs_for("before", rows[-1]) if rows and has_older else None
+    # plain text inside <pre>: build it with one join and escape it once instead of looping in Jinja
+    log_body = escape("".join(
+        LOG_ENTRY(local_stamp(int(r_ts)), r_ip, r_room or "-", r_token, r_content)
+        for r_ip, r_ts, r_content, r_token, r_room, _ in rows
+    ))
+    return stream_template(
+        ADMIN_LOGS_TPL,
+        log_body=log_body,
+        total=total_label,
         qs_prev=qs_prev,
         qs_next=qs_next,
         q=q,
@@ -692,7 +1353,6 @@ def admin_logs():
         ip=ip,
         date_from=date_from,
         date_to=date_to,
-        datetime=datetime,
     )
 
 
@@ -705,15 +1365,13 @@ def admin_logout():
 # ----------------------- ADMIN ACTIONS ----------------------------
 @app.route("/admin/ban", methods=["POST"])
 def admin_ban():
-    if not admin_required():
-        return redirect(url_for("admin_login"))
     token = request.form.get("token")
     if not token:
         flash("token required")
         return redirect(url_for("admin_manage"))
     ban_token(token)
     # disconnect sessions for that token
-    to_disconnect = [sid for sid, tok in sid_to_token.items() if tok == token]
+    to_disconnect = list(token_to_sids.get(token, ()))
     for sid in to_disconnect:
         try:
             socketio.disconnect(sid)
@@ -725,8 +1383,6 @@ def admin_ban():
 
 @app.route("/admin/unban", methods=["POST"])
 def admin_unban():
-    if not admin_required():
-        return redirect(url_for("admin_login"))
     token = request.form.get("token")
     if not token:
         flash("token required")
@@ -738,14 +1394,13 @@ def admin_unban():
 
 @app.route("/admin/kick", methods=["POST"])
 def admin_kick():
-    if not admin_required():
-        return redirect(url_for("admin_login"))
     sid = request.form.get("sid")
     if not sid:
         flash("sid required")
         return redirect(url_for("admin_manage"))
     try:
-        room = sid_to_room.get(sid)
+        sess = live_sessions.get(sid)
+        room = sess.room if sess else None
         if room:
             try:
                 sio_leave(room, sid=sid)
@@ -760,28 +1415,30 @@ def admin_kick():
 
 @app.route("/admin/move", methods=["POST"])
 def admin_move():
-    if not admin_required():
-        return redirect(url_for("admin_login"))
     sid = request.form.get("sid")
     room = (request.form.get("room") or "").strip()
     if not sid:
         flash("sid required")
         return redirect(url_for("admin_manage"))
+    sess = live_sessions.get(sid)
+    if not sess:
+        flash("unknown sid")
+        return redirect(url_for("admin_manage"))
     try:
-        current = sid_to_room.get(sid)
+        current = sess.room
         if current:
             try:
                 sio_leave(current, sid=sid)
             except Exception:
                 pass
         if not room:
-            sid_to_room[sid] = None
+            sess.room = None
             flash("removed from room")
         else:
             if not room_exists(room):
                 create_room(room, room, "")
             sio_join(room, sid=sid)
-            sid_to_room[sid] = room
+            sess.room = room
             flash("moved")
     except Exception as e:
         flash(f"error: {e}")
@@ -792,185 +1449,444 @@ def admin_move():
 @app.route("/upload", methods=["POST"])
 def upload():
     """
-    Accepts multipart/form-data file field 'file'.
+    Accepts multipart/form-data file field 'file', or a raw body with the
+    original name in an X-Filename header (URI-encoded).
     Saves file to UPLOAD_DIR and returns JSON {filename, url}
     """
-    f = request.files.get("file")
-    if not f or not f.filename:
-        return jsonify(error="No file"), 400
     try:
-        url = save_upload(f)
+        if request.mimetype == "multipart/form-data":
+            f = request.files.get("file")
+            if not f or not f.filename:
+                return jsonify(error="No file"), 400
+            filename = f.filename
+            url = save_upload(f)
+        else:
+            filename = unquote(request.headers.get("X-Filename", ""))
+            if not filename:
+                return jsonify(error="No file"), 400
+            url = save_upload_stream(request.stream, filename)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(filename=filename, url=external_url(url))
+
+
+@app.route("/upload/exists")
+def upload_exists():
+    """?sha=<sha256 hex>&name=<filename>; returns {filename, url} if that content is stored, else {url: null}."""
+    sha = request.args.get("sha", "").lower()
+    filename = request.args.get("name", "")
+    ext = upload_ext(filename)
+    if len(sha) != 64 or any(c not in "0123456789abcdef" for c in sha) or not ext:
+        return jsonify(error="bad request"), 400
+    unique = f"{sha[:32]}{ext}"  # same naming as _store_spool
+    if not (UPLOAD_DIR / unique).is_file():
+        return jsonify(url=None)
+    return jsonify(filename=filename, url=external_url(upload_url(unique)))
+
+
+@app.route("/upload/chunk", methods=["POST"])
+def upload_chunk():
+    """Raw body is part `idx` of `total` for resumable upload `uploadId`."""
+    if (request.content_length or 0) > CHUNK_PART_SIZE:
+        return jsonify(error="chunk too large"), 413
+    try:
+        idx = int(request.args.get("idx", ""))
+        total = int(request.args.get("total", ""))
+        save_upload_chunk(request.args.get("uploadId", ""), idx, total, request.stream)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    except RequestEntityTooLarge as e:
+        return jsonify(error=e.description), 413
+    return jsonify(ok=True)
+
+
+@app.route("/upload/status")
+def upload_status():
+    """Lists the parts already received, so an interrupted upload can resume."""
+    try:
+        part_dir = _chunk_dir(request.args.get("uploadId", ""))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(received=_received_parts(part_dir))
+
+
+@app.route("/upload/finalize", methods=["POST"])
+def upload_finalize():
+    """JSON {uploadId, total, filename}; returns JSON {filename, url} like /upload."""
+    data = request.get_json(silent=True) or {}
+    filename = data.get("filename") or ""
+    try:
+        url = finalize_chunked_upload(data.get("uploadId") or "", int(data.get("total") or 0), filename)
     except ValueError as e:
         return jsonify(error=str(e)), 400
-    return jsonify(filename=f.filename, url=url)
+    return jsonify(filename=filename, url=external_url(url))
 
 
 @app.route("/uploads/<path:filename>")
 def uploaded_file(filename):
-    return send_from_directory(UPLOAD_DIR, filename, as_attachment=False)
+    if filename.startswith("."):
+        abort(404)  # in-progress spools and chunk parts
+    if UPLOAD_ACCEL_PREFIX:
+        # nginx sends the file with sendfile(2); only headers leave Python
+        path = safe_join(str(UPLOAD_DIR), filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        resp = Response(mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream")
+        resp.headers["X-Accel-Redirect"] = f"{UPLOAD_ACCEL_PREFIX}/{filename}"
+    else:
+        resp = send_from_directory(UPLOAD_DIR, filename, as_attachment=False, conditional=True)
+    # names are content hashes, so a given URL never changes
+    resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return resp
 
 
 # ---------------------- CHAT UI / ROOM ----------------------------
-INDEX_HTML = """
-<!doctype html>
-<html>
-<head>
-  <meta charset="utf-8" />
-  <title>Chat — Rooms</title>
-  <style>
-    body{font-family:Arial;margin:16px}
-    #chat{border:1px solid #ccc;height:420px;overflow:auto;padding:6px}
-    p{margin:0 0 6px}
-    input{padding:6px}
-    button{padding:6px;margin-left:6px}
-    .user{color:blue;cursor:pointer}
-    .menu{margin-bottom:8px}
-    .info{color:#666;font-size:90%}
-  </style>
-</head>
-<body>
-  <h3 id="title">Public Chat</h3>
-  <div class="menu" id="menu">
-    <input id="nick" placeholder="nickname" />
-    <button id="enter" disabled>Enter</button>
-    <button id="host">Host Room</button>
-    <input id="joinCode" placeholder="room code" style="width:120px" />
-    <button id="joinBtn">Join</button>
-    <a href="/admin" style="margin-left:12px">Admin</a>
-  </div>
-
-  <div id="chatui" style="display:none;margin-top:10px">
-    <div id="roomInfo" class="info"></div>
-    <div id="chat"></div>
-    <div style="margin-top:6px">
-      <input id="msg" placeholder="message" style="width:58%" />
-      <button id="send">Send</button>
-      <button id="recBtn">🎤 Record</button>
-      <input type="file" id="fileInput" />
-      <button id="uploadBtn">Upload</button>
-    </div>
-  </div>
+# The page is a small shell; CSS and JS are served from /assets/<name>?v=<hash>
+# with an immutable cache, so browsers fetch them once per release.
+INDEX_CSS = """
+body{font-family:Arial;margin:16px}
+#chat{border:1px solid #ccc;height:420px;overflow:auto;padding:6px}
+p{margin:0 0 6px}
+input{padding:6px}
+button{padding:6px;margin-left:6px}
+.user{color:blue;cursor:pointer}
+.menu{margin-bottom:8px}
+.info{color:#666;font-size:90%}
+"""
 
-<script src="//cdnjs.cloudflare.com/ajax/libs/socket.io/4.7.1/socket.io.min.js"></script>
-<script>
+INDEX_JS = """
 const socket = io();
 let currentRoom = '';
-const DEFAULT_ROOM = "{{ default_room or '' }}";
-
-function addLine(txt){
-  const p=document.createElement('p'); p.innerHTML=txt;
-  document.getElementById('chat').appendChild(p);
-  document.getElementById('chat').scrollTop=document.getElementById('chat').scrollHeight;
+const DEFAULT_ROOM = (window.BOOT && window.BOOT.default_room) || '';
+
+// element handles and the saved token are looked up once, not on every click/keypress
+const chatEl = document.getElementById('chat');
+const titleEl = document.getElementById('title');
+const enterBtn = document.getElementById('enter');
+const nickInput = document.getElementById('nick');
+const hostBtn = document.getElementById('host');
+const joinCodeInput = document.getElementById('joinCode');
+const joinBtn = document.getElementById('joinBtn');
+const roomInfoEl = document.getElementById('roomInfo');
+const chatUi = document.getElementById('chatui');
+const msgInput = document.getElementById('msg');
+const sendBtn = document.getElementById('send');
+const fileInput = document.getElementById('fileInput');
+const uploadBtn = document.getElementById('uploadBtn');
+const recBtn = document.getElementById('recBtn');
+let chatToken = localStorage.getItem('chatToken');
+
+// attachments arrive as {type, url, name} and are built with DOM calls, never as HTML
+function buildAttach(a){
+  let el;
+  if(a.type==='image'){ el=document.createElement('img'); el.src=a.url; el.style.maxWidth='300px'; }
+  else if(a.type==='audio'){ el=document.createElement('audio'); el.controls=true; el.src=a.url; }
+  else { el=document.createElement('a'); el.href=a.url; el.target='_blank'; el.textContent=a.name; }
+  return el;
+}
+function buildLine(line){
+  const p=document.createElement('p');
+  if(typeof line === 'string') p.innerHTML=line;
+  else { p.innerHTML=line.head; p.appendChild(buildAttach(line.attach)); }
+  return p;
+}
+const MAX_LINES = 500;  // older lines are dropped so the DOM stays a constant size
+function appendLine(node){
+  chatEl.appendChild(node);
+  while(chatEl.childElementCount > MAX_LINES) chatEl.firstElementChild.remove();
+  chatEl.scrollTop=chatEl.scrollHeight;
+}
+// local notices are plain text (they can carry the user's name); only server-escaped chat lines use innerHTML
+function addLine(txt){ const p=document.createElement('p'); p.textContent=txt; appendLine(p); }
+// a batch of lines goes in through one fragment: one layout instead of one per line
+function addLines(lines){
+  const frag=document.createDocumentFragment();
+  lines.forEach(l=>frag.appendChild(buildLine(l)));
+  appendLine(frag);
 }
 function setTitle(){
-  document.getElementById('title').innerText = currentRoom ? ('Private Chat room code - ' + currentRoom) : 'Public Chat';
+  titleEl.innerText = currentRoom ? ('Private Chat room code - ' + currentRoom) : 'Public Chat';
 }
-socket.on('connect', ()=>{ document.getElementById('enter').disabled=false; });
+const LOC_ORIGIN = location.origin;
+const roomInfoStr = code => `Room: ${code} (link: ${LOC_ORIGIN}/room/${code})`;
+// every way into a room (host, join, /room/<code> link) goes through here
+function setRoom(code){
+  currentRoom = code;
+  joinCodeInput.value = code;
+  roomInfoEl.innerText = roomInfoStr(code);
+  chatUi.style.display='block';
+  setTitle();
+}
+socket.on('connect', ()=>{ enterBtn.disabled=false; });
 
-document.getElementById('enter').onclick = ()=> {
-  const nick = document.getElementById('nick').value.trim();
+enterBtn.onclick = ()=> {
+  const nick = nickInput.value.trim();
   if(!nick){ alert('enter nick'); return; }
-  const stored = localStorage.getItem('chatToken');
-  const payload = stored ? {name:nick, token:stored, room: currentRoom} : {name:nick, room: currentRoom};
+  const payload = chatToken ? {name:nick, token:chatToken, room: currentRoom} : {name:nick, room: currentRoom};
   socket.emit('register', payload);
 };
 
-document.getElementById('host').onclick = ()=>{
-  const nick=document.getElementById('nick').value.trim() || 'anon';
-  const code = Math.random().toString(36).slice(2,8).toUpperCase();
-  currentRoom = code;
-  document.getElementById('joinCode').value = code;
-  document.getElementById('roomInfo').innerText = 'Room: ' + code + ' (link: ' + location.origin + '/room/' + code + ')';
-  document.getElementById('chatui').style.display='block';
-  setTitle();
-  const stored=localStorage.getItem('chatToken');
-  const payload = stored ? {name:nick, token:stored, room: currentRoom} : {name:nick, room: currentRoom};
+hostBtn.onclick = ()=>{
+  const nick=nickInput.value.trim() || 'anon';
+  setRoom(Math.random().toString(36).slice(2,8).toUpperCase());
+  const payload = chatToken ? {name:nick, token:chatToken, room: currentRoom} : {name:nick, room: currentRoom};
   socket.emit('register', payload);
 };
 
-document.getElementById('joinBtn').onclick = ()=>{
-  const code = document.getElementById('joinCode').value.trim();
+joinBtn.onclick = ()=>{
+  const code = joinCodeInput.value.trim();
   if(!code){ alert('enter code'); return; }
-  currentRoom = code;
-  document.getElementById('roomInfo').innerText = 'Room: ' + code + ' (link: ' + location.origin + '/room/' + code + ')';
-  document.getElementById('chatui').style.display='block';
-  setTitle();
-  const nick = document.getElementById('nick').value.trim() || 'anon';
-  const stored = localStorage.getItem('chatToken');
-  const payload = stored ? {name:nick, token:stored, room: currentRoom} : {name:nick, room: currentRoom};
+  setRoom(code);
+  const nick = nickInput.value.trim() || 'anon';
+  const payload = chatToken ? {name:nick, token:chatToken, room: currentRoom} : {name:nick, room: currentRoom};
   socket.emit('register', payload);
 };
 
-(function(){
-  if(DEFAULT_ROOM){
-    currentRoom = DEFAULT_ROOM;
-    document.getElementById('joinCode').value = DEFAULT_ROOM;
-    document.getElementById('roomInfo').innerText = 'Room: ' + DEFAULT_ROOM + ' (link: ' + location.origin + '/room/' + DEFAULT_ROOM + ')';
-    document.getElementById('chatui').style.display='block';
-    setTitle();
-  }
-})();
+if(DEFAULT_ROOM) setRoom(DEFAULT_ROOM);
 
 socket.on('welcome', data=>{
+  chatToken = data.token;
   localStorage.setItem('chatToken', data.token);
-  document.getElementById('chatui').style.display='block';
+  chatUi.style.display='block';
   addLine('[INFO] You are '+data.name+' (public id: '+data.public_token+')' + (data.banned ? ' [BANNED]' : ''));
 });
-socket.on('history', lines=>{ lines.forEach(l=>addLine(l)); });
-socket.on('chat_line', line=>addLine(line));
+socket.on('history', addLines);
+socket.on('chat_batch', addLines);
+
+// Outbound backpressure: while the transport has more than SEND_HIGH_WATER bytes (websocket)
+// or packets (polling) unsent, hold messages locally and disable Send until it drains.
+const SEND_HIGH_WATER = 1024*1024, SEND_QUEUE_MAX = 100;
+const sendQueue = [];
+let drainTimer = null;
+function transportBusy(){
+  const eng = socket.io.engine;
+  if(!eng) return false;
+  const ws = eng.transport && eng.transport.ws;
+  return ws ? ws.bufferedAmount > SEND_HIGH_WATER : eng.writeBuffer.length > SEND_QUEUE_MAX;
+}
+function drainSendQueue(){
+  while(sendQueue.length && !transportBusy()) socket.emit('msg', sendQueue.shift());
+  if(sendQueue.length) return;
+  clearInterval(drainTimer); drainTimer = null;
+  sendBtn.disabled = false;
+}
+// body is {text} or {attach: {type, url, name}}
+function sendMsg(body){
+  body.room = currentRoom;
+  if(!sendQueue.length && !transportBusy()){ socket.emit('msg', body); return; }
+  if(sendQueue.length >= SEND_QUEUE_MAX){ addLine('[INFO] connection is backed up, message not sent'); return; }
+  sendQueue.push(body);
+  sendBtn.disabled = true;
+  if(!drainTimer) drainTimer = setInterval(drainSendQueue, 50);
+}
 
-document.getElementById('send').onclick = ()=>{
-  const txt = document.getElementById('msg').value.trim(); if(!txt) return;
-  socket.emit('msg', {text:txt, room: currentRoom}); document.getElementById('msg').value = '';
+sendBtn.onclick = ()=>{
+  const txt = msgInput.value.trim(); if(!txt) return;
+  sendMsg({text: txt}); msgInput.value = '';
 };
-document.getElementById('msg').addEventListener('keypress', e=>{ if(e.key==='Enter'){ document.getElementById('send').click(); } });
+// keydown rather than keypress; held-down Enter (auto-repeat) does not resend
+msgInput.addEventListener('keydown', e=>{
+  if(e.key!=='Enter' || e.repeat) return;
+  e.preventDefault(); sendBtn.click();
+});
 
-document.addEventListener('click', e=>{ if(e.target.classList.contains('user')) alert('Public token: '+e.target.dataset.pub); });
+// only user names carry data-pub, so that check alone identifies them
+chatEl.addEventListener('click', e=>{ const pub = e.target.dataset.pub; if(pub) alert('Public token: '+pub); });
+
+// Large files go up in CHUNK_SIZE slices, UPLOAD_PARALLEL at a time; the uploadId is
+// kept in localStorage so a retry of the same file only sends the missing parts.
+const CHUNK_SIZE = 1024*1024, UPLOAD_PARALLEL = 4;
+async function uploadChunked(f){
+  const key = 'upload:' + f.name + ':' + f.size + ':' + f.lastModified;
+  let id = localStorage.getItem(key);
+  if(!id){
+    id = Array.from(crypto.getRandomValues(new Uint8Array(16)), b=>b.toString(16).padStart(2,'0')).join('');
+    localStorage.setItem(key, id);
+  }
+  const total = Math.ceil(f.size / CHUNK_SIZE);
+  const st = await (await fetch('/upload/status?uploadId=' + id)).json();
+  const have = new Set(st.received || []);
+  const todo = [];
+  for(let i=0; i<total; i++) if(!have.has(i)) todo.push(i);
+  const worker = async ()=>{
+    while(todo.length){
+      const idx = todo.shift();
+      const res = await fetch(`/upload/chunk?uploadId=${id}&idx=${idx}&total=${total}`,
+        {method:'POST', body: f.slice(idx*CHUNK_SIZE, (idx+1)*CHUNK_SIZE)});
+      if(!res.ok) throw new Error('upload failed');
+    }
+  };
+  try { await Promise.all(Array.from({length: Math.min(UPLOAD_PARALLEL, todo.length)}, worker)); }
+  catch(e){ return {error: e.message + ' - retry to resume'}; }
+  const res = await fetch('/upload/finalize', {method:'POST', headers:{'Content-Type':'application/json'},
+    body: JSON.stringify({uploadId: id, total: total, filename: f.name})});
+  const j = await res.json();
+  if(!j.error) localStorage.removeItem(key);
+  return j;
+}
 
-// Upload flow: send file to /upload, server returns URL; then emit message with tag
-document.getElementById('uploadBtn').onclick = async ()=>{
-  const f = document.getElementById('fileInput').files[0];
-  if(!f){ alert('choose file'); return; }
-  const form = new FormData(); form.append('file', f);
-  const res = await fetch('/upload', {method:'POST', body: form});
+// Photos are downscaled to IMG_MAX_SIDE and re-encoded as WebP in the browser before upload.
+// GIFs keep their animation; anything that fails or does not shrink is sent as-is.
+const IMG_MAX_SIDE = 1600, IMG_QUALITY = 0.82;
+async function compressImage(f){
+  if(!f.type.startsWith('image/') || f.type === 'image/gif' || !window.OffscreenCanvas || !window.createImageBitmap) return f;
+  try {
+    const bmp = await createImageBitmap(f);
+    const scale = Math.min(1, IMG_MAX_SIDE / Math.max(bmp.width, bmp.height));
+    const canvas = new OffscreenCanvas(Math.round(bmp.width*scale), Math.round(bmp.height*scale));
+    canvas.getContext('2d').drawImage(bmp, 0, 0, canvas.width, canvas.height);
+    bmp.close();
+    const blob = await canvas.convertToBlob({type:'image/webp', quality: IMG_QUALITY});
+    if(blob.type !== 'image/webp' || blob.size >= f.size) return f;
+    return new File([blob], f.name.replace(/[.][^.]*$/, '') + '.webp', {type: 'image/webp'});
+  } catch(e){ return f; }
+}
+
+// Files are stored under their SHA-256, so ask the server first and skip the body if it has it.
+// crypto.subtle only exists on secure origins; elsewhere this just falls through to the upload.
+async function findExisting(f){
+  if(!(window.crypto && crypto.subtle)) return null;
+  const digest = await crypto.subtle.digest('SHA-256', await f.arrayBuffer());
+  const hex = Array.from(new Uint8Array(digest), b=>b.toString(16).padStart(2,'0')).join('');
+  const res = await fetch('/upload/exists?sha=' + hex + '&name=' + encodeURIComponent(f.name));
+  if(!res.ok) return null;
   const j = await res.json();
+  return j.url ? j : null;
+}
+
+// Single-request uploads send the bytes as the raw body with the name in X-Filename;
+// the server streams that straight to disk with no multipart parsing.
+async function uploadBlob(blob, name){
+  const headers = {'X-Filename': encodeURIComponent(name)};
+  if(blob.type) headers['Content-Type'] = blob.type;
+  const res = await fetch('/upload', {method:'POST', headers: headers, body: blob});
+  return res.json();
+}
+
+// Upload flow: send file to /upload, server returns URL; then emit message with tag
+uploadBtn.onclick = async ()=>{
+  const picked = fileInput.files[0];
+  if(!picked){ alert('choose file'); return; }
+  const f = await compressImage(picked);
+  let j = await findExisting(f);
+  if(!j && f.size > CHUNK_SIZE) j = await uploadChunked(f);
+  else if(!j) j = await uploadBlob(f, f.name);
   if(j.error){ alert(j.error); return; }
-  const ext = f.name.split('.').pop().toLowerCase();
-  let msg;
-  if(f.type.startsWith('image/')) msg = `<img src="${j.url}" style="max-width:300px"/>`;
-  else if(f.type.startsWith('audio/')) msg = `<audio controls src="${j.url}"></audio>`;
-  else msg = `<a href="${j.url}" target="_blank">${j.filename}</a>`;
-  socket.emit('msg', {text: msg, room: currentRoom});
+  const type = f.type.startsWith('image/') ? 'image' : f.type.startsWith('audio/') ? 'audio' : 'file';
+  sendMsg({attach: {type: type, url: j.url, name: j.filename}});
 };
 
 // recorder -> upload blob to /upload
-let rec, chunks = [];
-document.getElementById('recBtn').onclick = async ()=>{
+// voice notes: mono speech-tuned capture, Opus at 24 kbps where the browser supports it
+const VOICE_CONSTRAINTS = {audio: {channelCount:1, sampleRate:16000, echoCancellation:true, noiseSuppression:true}};
+const VOICE_TYPES = ['audio/webm;codecs=opus', 'audio/ogg;codecs=opus', 'audio/webm'];
+function recorderOptions(){
+  const opts = {audioBitsPerSecond: 24000};
+  const type = window.MediaRecorder && MediaRecorder.isTypeSupported ? VOICE_TYPES.find(t=>MediaRecorder.isTypeSupported(t)) : null;
+  if(type) opts.mimeType = type;
+  return opts;
+}
+// the mic stream is kept between recordings so later starts skip getUserMedia;
+// it is released whenever the page is hidden and not recording
+let rec, chunks = [], micStream = null;
+async function getMic(){
+  if(!micStream) micStream = await navigator.mediaDevices.getUserMedia(VOICE_CONSTRAINTS);
+  return micStream;
+}
+function releaseMic(){
+  if(!micStream || (rec && rec.state==='recording')) return;
+  micStream.getTracks().forEach(t=>t.stop()); micStream = null;
+}
+document.addEventListener('visibilitychange', ()=>{ if(document.hidden) releaseMic(); });
+window.addEventListener('pagehide', releaseMic);
+recBtn.onclick = async ()=>{
   if(!rec || rec.state==='inactive'){
-    const stream = await navigator.mediaDevices.getUserMedia({audio:true});
-    rec = new MediaRecorder(stream);
+    rec = new MediaRecorder(await getMic(), recorderOptions());
     rec.ondataavailable = e=>chunks.push(e.data);
     rec.onstop = async ()=>{
-      const blob = new Blob(chunks, {type: 'audio/webm'}); chunks=[];
-      const form = new FormData(); form.append('file', blob, 'voice.webm');
-      const res = await fetch('/upload', {method:'POST', body: form});
-      const j = await res.json();
+      const type = (rec.mimeType || 'audio/webm').split(';')[0];
+      const blob = new Blob(chunks, {type: type}); chunks=[];
+      if(document.hidden) releaseMic();
+      const j = await uploadBlob(blob, type === 'audio/ogg' ? 'voice.ogg' : 'voice.webm');
       if(j.error){ alert(j.error); return; }
-      const msg = `<audio controls src="${j.url}"></audio>`;
-      socket.emit('msg', {text: msg, room: currentRoom});
+      sendMsg({attach: {type: 'audio', url: j.url, name: j.filename}});
     };
-    rec.start(); document.getElementById('recBtn').innerText='⏹ Stop';
-  } else { rec.stop(); document.getElementById('recBtn').innerText='🎤 Record'; }
+    rec.start(); recBtn.innerText='⏹ Stop';
+  } else { rec.stop(); recBtn.innerText='🎤 Record'; }
 };
-</script>
+"""
+
+STATIC_ASSETS = {
+    "app.css": ("text/css", INDEX_CSS.encode()),
+    "app.js": ("application/javascript", INDEX_JS.encode()),
+}
+ASSET_VERSIONS = {name: hashlib.sha256(body).hexdigest()[:12] for name, (_, body) in STATIC_ASSETS.items()}
+
+INDEX_HTML = """
+<!doctype html>
+<html>
+<head>
+  <meta charset="utf-8" />
+  <title>Chat — Rooms</title>
+  <link rel="stylesheet" href="/assets/app.css?v={{ versions['app.css'] }}" />
+</head>
+<body>
+  <h3 id="title">Public Chat</h3>
+  <div class="menu" id="menu">
+    <input id="nick" placeholder="nickname" />
+    <button id="enter" disabled>Enter</button>
+    <button id="host">Host Room</button>
+    <input id="joinCode" placeholder="room code" style="width:120px" />
+    <button id="joinBtn">Join</button>
+    <a href="/admin" style="margin-left:12px">Admin</a>
+  </div>
+
+  <div id="chatui" style="display:none;margin-top:10px">
+    <div id="roomInfo" class="info"></div>
+    <div id="chat"></div>
+    <div style="margin-top:6px">
+      <input id="msg" placeholder="message" style="width:58%" />
+      <button id="send">Send</button>
+      <button id="recBtn">🎤 Record</button>
+      <input type="file" id="fileInput" />
+      <button id="uploadBtn">Upload</button>
+    </div>
+  </div>
+
+<script src="//cdnjs.cloudflare.com/ajax/libs/socket.io/4.7.1/socket.io.min.js"></script>
+<script>window.BOOT = {{ boot|tojson }};</script>
+<script src="/assets/app.js?v={{ versions['app.js'] }}"></script>
 </body>
 </html>
 """
 
+INDEX_TPL = app.jinja_env.from_string(INDEX_HTML)
+# the lobby page has no per-request variables, so render it once
+INDEX_LOBBY_HTML = INDEX_TPL.render(boot={"default_room": ""}, versions=ASSET_VERSIONS)
+
 # ------------------------- ROUTES & START --------------------------
+class NoDelayListener:
+    """Listening socket whose accepted connections have Nagle disabled.
+
+    Chat frames are tiny; without TCP_NODELAY the kernel may hold each one
+    back waiting for the previous ACK. Used in place of socketio.run().
+    """
+
+    def __init__(self, sock):
+        self._sock = sock
+
+    def accept(self):
+        conn, addr = self._sock.accept()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn, addr
+
+    def __getattr__(self, attr):
+        return getattr(self._sock, attr)
+
+
 @app.route("/")
 def index():
-    return render_template_string(INDEX_HTML, default_room="", admin_pass=ADMIN_USER)
+    return INDEX_LOBBY_HTML
 
 
 @app.route("/room/<code>")
@@ -978,10 +1894,26 @@ def room_route(code):
     # persist room server-side
     if not room_exists(code):
         create_room(code, code, "")
-    return render_template_string(INDEX_HTML, default_room=code, admin_pass=ADMIN_USER)
+    return render_template(INDEX_TPL, boot={"default_room": code}, versions=ASSET_VERSIONS)
+
+
+@app.route("/assets/<name>")
+def asset(name):
+    entry = STATIC_ASSETS.get(name)
+    if not entry:
+        abort(404)
+    mimetype, body = entry
+    resp = Response(body, mimetype=mimetype)
+    resp.set_etag(ASSET_VERSIONS[name])
+    # URLs carry the content hash, so a cached copy never goes stale
+    resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return resp.make_conditional(request)
 
 
 if __name__ == "__main__":
     init_db()
+    socketio.start_background_task(session_reaper)
     print(f"Starting server on 0.0.0.0:{PORT}  (admin_user={ADMIN_USER})")
-    socketio.run(app, host="0.0.0.0", port=PORT)
+    eventlet.wsgi.server(NoDelayListener(eventlet.listen(("0.0.0.0", PORT))), app)
+    flush_messages()
+    close_db()